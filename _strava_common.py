@@ -0,0 +1,154 @@
+"""
+Helpers shared by authorize.py and strava-checker.py.
+"""
+
+import http.server
+import mmap
+import os
+import re
+import time
+import urllib.parse
+
+# Default location of the credentials file
+ENV_PATH = '.env'
+
+# Matches a KEY=value line in .env content, capturing the key and its value
+_ENV_RE = re.compile(rb'(?m)^([A-Z_]+)=([^\r\n]*)')
+
+def write_file_atomic(filepath, data, mode=0o644):
+    """
+    Write bytes to a temporary file and move it over filepath,
+    so a crash never leaves a truncated file behind.
+    """
+    tmp_path = filepath + '.tmp'
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, mode)
+    try:
+        try:
+            view = memoryview(data)
+            while view:
+                view = view[os.write(fd, view):]
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        os.replace(tmp_path, filepath)
+    except BaseException:
+        # Don't leave a partial copy (possibly holding tokens) behind
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
+
+def _parse_env(data):
+    """
+    Map each key in .env content to the spans of all of its values.
+    python-dotenv uses the last assignment, so every occurrence has to be updated.
+    """
+    spans = {}
+    for match in _ENV_RE.finditer(data):
+        spans.setdefault(match.group(1), []).append(match.span(2))
+    return spans
+
+def _merge_env(data, spans, updates):
+    """
+    Return the .env content with the given keys replaced or appended.
+    """
+    parts = []
+    pos = 0
+    replacements = sorted(
+        (start, end, value)
+        for key, value in updates.items()
+        for start, end in spans.get(key, ())
+    )
+    for start, end, value in replacements:
+        parts.append(data[pos:start])
+        parts.append(value)
+        pos = end
+    parts.append(data[pos:])
+    missing = [key + b'=' + value + b'\n' for key, value in updates.items() if key not in spans]
+    if missing and data and not data.endswith(b'\n'):
+        parts.append(b'\n')
+    parts.extend(missing)
+    return b''.join(parts)
+
+def update_env_file(token_response, env_path=ENV_PATH):
+    """
+    Update the .env file with new tokens and, when given, their expiry time.
+
+    When every token line already exists with values of the same length
+    (the usual case for Strava tokens) the values are patched in place.
+    Otherwise the file is rewritten atomically.
+    """
+    updates = {
+        b'ACCESS_TOKEN': token_response['access_token'].encode(),
+        b'REFRESH_TOKEN': token_response['refresh_token'].encode(),
+    }
+    if token_response.get('expires_at') is not None:
+        updates[b'EXPIRES_AT'] = str(int(token_response['expires_at'])).encode()
+
+    data = b''
+    spans = {}
+    try:
+        fd = os.open(env_path, os.O_RDWR)
+    except FileNotFoundError:
+        pass
+    else:
+        try:
+            if os.fstat(fd).st_size:
+                with mmap.mmap(fd, 0) as mm:
+                    spans = _parse_env(mm)
+                    if all(key in spans and all(end - start == len(value) for start, end in spans[key])
+                           for key, value in updates.items()):
+                        for key, value in updates.items():
+                            for start, end in spans[key]:
+                                mm[start:end] = value
+                        mm.flush()
+                        return
+                    data = mm[:]
+        finally:
+            os.close(fd)
+
+    write_file_atomic(env_path, _merge_env(data, spans, updates), mode=0o600)
+
+def create_local_server(port=8000):
+    """
+    Create a local server to handle the OAuth callback.
+    The authorization code is stored on the server's auth_code attribute.
+    """
+    class OAuthHandler(http.server.SimpleHTTPRequestHandler):
+        def setup(self):
+            # Bound reads from the client by the wait deadline, so a silent
+            # connection cannot hold up wait_for_code
+            if self.server.deadline is not None:
+                self.timeout = max(self.server.deadline - time.monotonic(), 0.01)
+            super().setup()
+
+        def do_GET(self):
+            query_components = urllib.parse.parse_qs(urllib.parse.urlparse(self.path).query)
+            
+            self.send_response(200)
+            self.send_header('Content-type', 'text/html')
+            self.end_headers()
+            self.wfile.write(b"Authorization successful! You can close this window.")
+            
+            if 'code' in query_components:
+                self.server.auth_code = query_components['code'][0]
+    
+    httpd = http.server.HTTPServer(('localhost', port), OAuthHandler)
+    httpd.auth_code = None
+    httpd.deadline = None
+    
+    return httpd
+
+def wait_for_code(server, timeout=60):
+    """
+    Handle callback requests on the current thread until an authorization code arrives
+    """
+    deadline = server.deadline = time.monotonic() + timeout
+    while server.auth_code is None:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise TimeoutError("No authorization code received")
+        server.timeout = remaining
+        server.handle_request()
+    return server.auth_code
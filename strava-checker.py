@@ -51,19 +51,30 @@ This script will:
   • Append any new activities to the list and rewrite the JSON file.
 """
 
+import array
+import concurrent.futures
+import heapq
 import json
+import operator
 import os
-import webbrowser
+import struct
+import time
 from stravalib.client import Client
 from dotenv import load_dotenv
+from _strava_common import update_env_file, write_file_atomic
 import logging
-import http.server
-import socketserver
-import threading
-import urllib.parse
-from queue import Queue
 import argparse
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
 # Set up logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -78,42 +89,62 @@ CLIENT_ID = os.getenv('CLIENT_ID')
 CLIENT_SECRET = os.getenv('CLIENT_SECRET')
 ACCESS_TOKEN = os.getenv('ACCESS_TOKEN')
 REFRESH_TOKEN = os.getenv('REFRESH_TOKEN')
+EXPIRES_AT = os.getenv('EXPIRES_AT')
+
+# Refresh the access token this many seconds before it expires
+TOKEN_EXPIRY_MARGIN = 300
 
 # JSON file where activities will be stored
 ACTIVITIES_FILE = 'activities.json'
 
-def create_local_server(port=8000, auth_queue=None):
-    """
-    Create a local server to handle the OAuth callback
-    """
-    class OAuthHandler(http.server.SimpleHTTPRequestHandler):
-        def do_GET(self):
-            # Parse the authorization code from the callback URL
-            query_components = urllib.parse.parse_qs(urllib.parse.urlparse(self.path).query)
-            
-            # Send a response to the browser
-            self.send_response(200)
-            self.send_header('Content-type', 'text/html')
-            self.end_headers()
-            self.wfile.write(b"Authorization successful! You can close this window.")
-            
-            # Put the code in the queue
-            if auth_queue and 'code' in query_components:
-                auth_queue.put(query_components['code'][0])
-    
-    # Create and start server in a separate thread
-    httpd = socketserver.TCPServer(('localhost', port), OAuthHandler)
-    server_thread = threading.Thread(target=httpd.serve_forever)
-    server_thread.daemon = True
-    server_thread.start()
-    
-    return httpd
+# Sort key of the activities file; it is always kept sorted by start date
+_START_DATE_KEY = operator.itemgetter('start_date_local')
+
+# Header of the activity id cache: mtime_ns and size of the activities file
+_IDS_CACHE_HEADER = struct.Struct('<qq')
+
+# Activity fields copied by activity_to_dict, as (attribute, cast, default).
+# The default is used when the attribute is missing, None or fails to cast.
+_ACTIVITY_FIELDS = (
+    ('distance', float, 0.0),
+    ('moving_time', int, 0),
+    ('elapsed_time', int, 0),
+    # Optional numeric properties
+    ('total_elevation_gain', float, None),
+    ('average_speed', float, None),
+    ('max_speed', float, None),
+    ('average_heartrate', float, None),
+    ('max_heartrate', float, None),
+    ('average_cadence', float, None),
+    ('average_watts', float, None),
+    ('calories', float, None),
+    # Optional integer properties
+    ('kudos_count', int, 0),
+    ('achievement_count', int, 0),
+    ('athlete_count', int, 0),
+    # Optional string properties
+    ('gear_id', str, None),
+    ('device_name', str, None),
+    # Optional boolean properties
+    ('private', bool, False),
+    ('commute', bool, False),
+)
 
 def get_token():
     """
     Get a valid access token, using refresh token if possible
     """
     try:
+        # Reuse the stored access token while it is still valid
+        if ACCESS_TOKEN and EXPIRES_AT:
+            try:
+                expires_at = int(EXPIRES_AT)
+            except ValueError:
+                expires_at = 0
+            if time.time() < expires_at - TOKEN_EXPIRY_MARGIN:
+                logger.info("Using stored access token")
+                return ACCESS_TOKEN
+        
         # First try to refresh the token
         if REFRESH_TOKEN:
             try:
@@ -132,7 +163,7 @@ def get_token():
                 return refresh_response['access_token']
                 
             except Exception as e:
-                logger.warning(f"Token refresh failed: {str(e)}")
+                logger.warning("Token refresh failed: %s", e)
         
         # If we don't have a refresh token or refresh failed, we need manual authorization
         if not REFRESH_TOKEN:
@@ -142,46 +173,9 @@ def get_token():
         raise ValueError("Failed to get valid access token")
         
     except Exception as e:
-        logger.error(f"Failed to get access token: {str(e)}")
+        logger.error("Failed to get access token: %s", e)
         raise
 
-def update_env_file(token_response):
-    """
-    Update the .env file with new tokens
-    """
-    env_path = '.env'
-    
-    # Read existing content
-    if os.path.exists(env_path):
-        with open(env_path, 'r') as file:
-            lines = file.readlines()
-    else:
-        lines = []
-    
-    # Update or add tokens
-    tokens_updated = {'ACCESS_TOKEN': False, 'REFRESH_TOKEN': False}
-    new_lines = []
-    
-    for line in lines:
-        if line.startswith('ACCESS_TOKEN='):
-            new_lines.append(f"ACCESS_TOKEN={token_response['access_token']}\n")
-            tokens_updated['ACCESS_TOKEN'] = True
-        elif line.startswith('REFRESH_TOKEN='):
-            new_lines.append(f"REFRESH_TOKEN={token_response['refresh_token']}\n")
-            tokens_updated['REFRESH_TOKEN'] = True
-        else:
-            new_lines.append(line)
-    
-    # Add any missing tokens
-    if not tokens_updated['ACCESS_TOKEN']:
-        new_lines.append(f"ACCESS_TOKEN={token_response['access_token']}\n")
-    if not tokens_updated['REFRESH_TOKEN']:
-        new_lines.append(f"REFRESH_TOKEN={token_response['refresh_token']}\n")
-    
-    # Write back to file
-    with open(env_path, 'w') as file:
-        file.writelines(new_lines)
-
 def refresh_access_token():
     """
     Refresh the access token using the refresh token
@@ -203,19 +197,88 @@ def load_existing_activities(filepath):
     Returns a list of activities or an empty list if file does not exist or is empty.
     """
     if os.path.exists(filepath):
-        with open(filepath, 'r') as f:
-            try:
-                return json.load(f)
-            except json.JSONDecodeError:
-                return []
+        with open(filepath, 'rb') as f:
+            data = f.read()
+        try:
+            return orjson.loads(data) if orjson is not None else json.loads(data)
+        except json.JSONDecodeError:
+            return []
     return []
 
+def load_existing_ids(filepath):
+    """
+    Load only the ids of the existing activities in a JSON file.
+    Streams the file with ijson when available so the full list is never built.
+    Returns an empty set if the file does not exist or is invalid.
+    """
+    if ijson is None:
+        return {activity['id'] for activity in load_existing_activities(filepath) if 'id' in activity}
+    if os.path.exists(filepath):
+        with open(filepath, 'rb') as f:
+            try:
+                return {int(activity_id) for activity_id in ijson.items(f, 'item.id')}
+            except ijson.JSONError:
+                return set()
+    return set()
+
+def _ids_cache_path(filepath):
+    """
+    Return the path of the id cache belonging to an activities file.
+    """
+    return os.path.splitext(filepath)[0] + '.ids.cache'
+
+def _load_ids_cache(filepath):
+    """
+    Load the cached activity ids for filepath.
+    Returns None if the cache is missing or was written for a different version of the file.
+    """
+    try:
+        stat = os.stat(filepath)
+        with open(_ids_cache_path(filepath), 'rb') as f:
+            data = f.read()
+    except OSError:
+        return None
+    header_size = _IDS_CACHE_HEADER.size
+    if len(data) < header_size or (len(data) - header_size) % 8:
+        return None
+    if _IDS_CACHE_HEADER.unpack_from(data) != (stat.st_mtime_ns, stat.st_size):
+        return None
+    ids = array.array('q')
+    ids.frombytes(memoryview(data)[header_size:])
+    return set(ids)
+
+def _save_ids_cache(filepath, ids):
+    """
+    Store the activity ids of filepath together with its current mtime and size.
+    """
+    try:
+        stat = os.stat(filepath)
+        data = _IDS_CACHE_HEADER.pack(stat.st_mtime_ns, stat.st_size) + array.array('q', ids).tobytes()
+        write_file_atomic(_ids_cache_path(filepath), data)
+    except (OSError, OverflowError, TypeError) as e:
+        logger.warning("Failed to write activity id cache: %s", e)
+
+def load_known_ids(filepath):
+    """
+    Load the ids of the stored activities, from the id cache when it is current.
+    """
+    ids = _load_ids_cache(filepath)
+    if ids is None:
+        ids = load_existing_ids(filepath)
+        if os.path.exists(filepath):
+            _save_ids_cache(filepath, ids)
+    return ids
+
 def save_activities(filepath, activities):
     """
     Save the list of activities to a JSON file with indentation for readability.
+    Uses orjson when it is installed and replaces the file atomically.
     """
-    with open(filepath, 'w') as f:
-        json.dump(activities, f, indent=4)
+    if orjson is not None:
+        data = orjson.dumps(activities, option=orjson.OPT_INDENT_2)
+    else:
+        data = json.dumps(activities, indent=2, ensure_ascii=False).encode()
+    write_file_atomic(filepath, data)
 
 def activity_to_dict(activity):
     """
@@ -229,86 +292,23 @@ def activity_to_dict(activity):
             'name': str(activity.name),
             'start_date_local': str(activity.start_date_local),
             'type': str(activity.type),
-            'distance': float(activity.distance) if hasattr(activity, 'distance') and activity.distance else 0.0,
-            'moving_time': int(activity.moving_time) if hasattr(activity, 'moving_time') and activity.moving_time else 0,
-            'elapsed_time': int(activity.elapsed_time) if hasattr(activity, 'elapsed_time') and activity.elapsed_time else 0,
         }
 
-        # Optional numeric properties with proper null handling
-        float_properties = {
-            'total_elevation_gain': 'total_elevation_gain',
-            'average_speed': 'average_speed',
-            'max_speed': 'max_speed',
-            'average_heartrate': 'average_heartrate',
-            'max_heartrate': 'max_heartrate',
-            'average_cadence': 'average_cadence',
-            'average_watts': 'average_watts',
-            'calories': 'calories',
-        }
-        
-        for key, attr in float_properties.items():
-            try:
-                if hasattr(activity, attr):
-                    value = getattr(activity, attr)
-                    result[key] = float(value) if value is not None else None
-                else:
-                    result[key] = None
-            except (AttributeError, TypeError, ValueError):
-                result[key] = None
-
-        # Optional integer properties
-        int_properties = {
-            'kudos_count': 'kudos_count',
-            'achievement_count': 'achievement_count',
-            'athlete_count': 'athlete_count',
-        }
-        
-        for key, attr in int_properties.items():
-            try:
-                if hasattr(activity, attr):
-                    value = getattr(activity, attr)
-                    result[key] = int(value) if value is not None else 0
-                else:
-                    result[key] = 0
-            except (AttributeError, TypeError, ValueError):
-                result[key] = 0
-
-        # Optional string properties
-        str_properties = {
-            'gear_id': 'gear_id',
-            'device_name': 'device_name',
-        }
-        
-        for key, attr in str_properties.items():
-            try:
-                if hasattr(activity, attr):
-                    value = getattr(activity, attr)
-                    result[key] = str(value) if value is not None else None
-                else:
-                    result[key] = None
-            except (AttributeError, TypeError, ValueError):
-                result[key] = None
-
-        # Optional boolean properties
-        bool_properties = {
-            'private': 'private',
-            'commute': 'commute',
-        }
-        
-        for key, attr in bool_properties.items():
+        for attr, cast, default in _ACTIVITY_FIELDS:
+            value = getattr(activity, attr, None)
+            if value is None:
+                result[attr] = default
+                continue
             try:
-                if hasattr(activity, attr):
-                    value = getattr(activity, attr)
-                    result[key] = bool(value) if value is not None else False
-                else:
-                    result[key] = False
-            except (AttributeError, TypeError, ValueError):
-                result[key] = False
+                result[attr] = cast(value)
+            except (TypeError, ValueError):
+                logger.debug("Could not convert %s of activity %s", attr, result['id'])
+                result[attr] = default
 
         return result
 
     except Exception as e:
-        logger.error(f"Error converting activity {activity.id} to dict: {str(e)}")
+        logger.error("Error converting activity %s to dict: %s", activity.id, e)
         # Return minimal dict with basic info
         return {
             'id': int(activity.id),
@@ -320,6 +320,20 @@ def activity_to_dict(activity):
             'elapsed_time': 0
         }
 
+def convert_new_activity(activity, existing_ids):
+    """
+    Convert an activity that is not stored yet.
+    Returns None for known activities and for activities that fail to convert.
+    """
+    try:
+        # Skip known activities before paying for the conversion
+        if int(activity.id) in existing_ids:
+            return None
+        return activity_to_dict(activity)
+    except Exception as e:
+        logger.warning("Failed to process activity %s: %s", getattr(activity, 'id', None), e)
+        return None
+
 def parse_args():
     """
     Parse command line arguments
@@ -352,6 +366,11 @@ def main():
         else:
             logger.info("Mode: Incremental update")
         
+        # Load the stored activity ids in the background while talking to Strava
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        ids_future = None if args.full_refresh else executor.submit(load_known_ids, ACTIVITIES_FILE)
+        executor.shutdown(wait=False)
+        
         # Get valid access token
         access_token = get_token()
         
@@ -359,12 +378,14 @@ def main():
         client = Client(access_token=access_token)
         
         try:
-            logger.info(f"Fetching activities from Strava (limit: {args.limit})...")
+            logger.info("Fetching activities from Strava (limit: %s)...", args.limit)
+            # stravalib requests up to 200 activities per page, so any limit up to
+            # 200 is fetched in a single API call
             strava_activities = list(client.get_activities(limit=args.limit))
-            logger.info(f"Successfully fetched {len(strava_activities)} activities")
+            logger.info("Successfully fetched %s activities", len(strava_activities))
             
         except Exception as e:
-            logger.error(f"Failed to get activities: {str(e)}")
+            logger.error("Failed to get activities: %s", e)
             return
             
         # Process activities
@@ -372,42 +393,40 @@ def main():
         
         if args.full_refresh:
             # For full refresh, we don't load existing activities
-            existing_activities = []
             existing_ids = set()
             logger.info("Full refresh: Clearing existing activities")
         else:
-            # For incremental update, load existing activities
-            existing_activities = load_existing_activities(ACTIVITIES_FILE)
-            existing_ids = {activity.get('id') for activity in existing_activities if 'id' in activity}
+            # For incremental update, only the ids are needed to find new activities
+            existing_ids = ids_future.result()
         
-        new_activities = []
-        for activity in strava_activities:
-            try:
-                activity_dict = activity_to_dict(activity)
-                if activity_dict['id'] not in existing_ids:
-                    new_activities.append(activity_dict)
-            except Exception as e:
-                logger.warning(f"Failed to process activity {activity.id}: {str(e)}")
-                continue
+        new_activities = [
+            activity_dict
+            for activity_dict in (convert_new_activity(activity, existing_ids) for activity in strava_activities)
+            if activity_dict is not None
+        ]
         
         if new_activities or args.full_refresh:
+            new_activities.sort(key=_START_DATE_KEY)
             if args.full_refresh:
-                logger.info(f"Saving {len(new_activities)} activities to {ACTIVITIES_FILE}")
+                logger.info("Saving %s activities to %s", len(new_activities), ACTIVITIES_FILE)
                 updated_activities = new_activities
             else:
-                logger.info(f"Found {len(new_activities)} new activities. Appending to {ACTIVITIES_FILE}")
-                updated_activities = existing_activities + new_activities
+                logger.info("Found %s new activities. Appending to %s", len(new_activities), ACTIVITIES_FILE)
+                # The stored activities are already sorted, so merge instead of re-sorting
+                updated_activities = list(heapq.merge(
+                    load_existing_activities(ACTIVITIES_FILE), new_activities, key=_START_DATE_KEY))
             
-            updated_activities.sort(key=lambda x: x.get('start_date_local', ''))
             save_activities(ACTIVITIES_FILE, updated_activities)
+            existing_ids.update(activity['id'] for activity in new_activities)
+            _save_ids_cache(ACTIVITIES_FILE, existing_ids)
             logger.info("Successfully updated activities file!")
         else:
             logger.info("No new activities found.")
             
     except ValueError as ve:
-        logger.error(f"Configuration error: {ve}")
+        logger.error("Configuration error: %s", ve)
     except Exception as e:
-        logger.error(f"An error occurred: {str(e)}")
+        logger.error("An error occurred: %s", e)
 
 if __name__ == '__main__':
     main()